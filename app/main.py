@@ -1,46 +1,112 @@
+import re
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import shorten
 from urllib.parse import urlparse
 
 import nltk
-import tldextract
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, stream_template
+from markupsafe import Markup
 from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from utils import _SnippetGenerator, db_conn
+from utils import (
+    _compile_regex_for_query,
+    _extract_page_text,
+    _trim_text_window,
+    _LRUCache,
+    _SnippetGenerator,
+    db_conn,
+    generate_breadcrumb,
+    get_domain,
+    init_pool,
+)
 
 app = Flask(__name__)
-
-nltk.download("stopwords")
-nltk.download("punkt_tab")
-stop_words = set(stopwords.words("english"))
+pool = init_pool()
+
+# Only download the stop words if they aren't already on disk
+try:
+    nltk.data.find("corpora/stopwords")
+except LookupError:
+    nltk.download("stopwords")
+
+stop_words = frozenset(stopwords.words("english"))
+# Queries are only a few words long, so splitting them on runs of word characters is enough to tokenize them
+query_term_pattern = re.compile(r"\w+")
+# selectolax releases the GIL while it parses html, so pages can be parsed in parallel with threads
+html_parser_pool = ThreadPoolExecutor(max_workers=4)
+# The snippet generator holds no state, so every search result can share one
+snippet_generator = _SnippetGenerator()
+# Snippets of pages, keyed by the id of the page and the sorted terms of the query
+snippet_cache = _LRUCache(max_size=4096)
+
+SEARCH_PAGES_SQL = """
+    WITH ranked_pages AS (
+        SELECT page_id, SUM(score) * COUNT(term) AS relevance
+        FROM term_scores
+        WHERE term = ANY(%(terms)s::text[])
+        -- If two terms have TF-IDF scores for the same page, then add them up
+        GROUP BY page_id
+        -- Order with tf_idf scores from largest to smallest, giving a boost to pages with more terms in the query
+        ORDER BY relevance DESC
+        LIMIT 10
+    )
+    SELECT
+        pages.id,
+        pages.url,
+        pages.title,
+        -- Snippets only ever show the text around the first term from the query,
+        -- so only send that part of the page instead of all of its text
+        CASE
+            WHEN pages.body_text IS NULL THEN NULL
+            WHEN first_match.position IS NULL THEN ''
+            ELSE substring(pages.body_text FROM greatest(first_match.position - 300, 1) FOR 1000)
+        END AS body_text,
+        -- Where the text above starts in the page, since it may start in the middle of a phrase
+        greatest(first_match.position - 300, 1) AS window_start,
+        -- Pages crawled before the body_text column existed still need their html to generate a snippet
+        CASE WHEN pages.body_text IS NULL THEN pages.html END AS html
+    FROM ranked_pages
+    -- Then, connect the two tables by their page id columns
+    JOIN pages ON pages.id = ranked_pages.page_id
+    CROSS JOIN LATERAL (
+        SELECT min(NULLIF(strpos(lower(pages.body_text), term), 0)) AS position
+        FROM unnest(%(terms)s::text[]) AS term
+    ) AS first_match
+    ORDER BY ranked_pages.relevance DESC;
+"""
 
 
 class SearchResult:
-    def __init__(self, url="", title=""):
+    __slots__ = ("url", "title", "domain", "breadcrumb", "snippet")
+
+    def __init__(self, url="", title="", domain="", breadcrumb=""):
         self.url = url
         self.title = title
-        self.snippet_generator = _SnippetGenerator()
-
-        if url:
-            self.domain = self.__get_domain(url)
-            self.breadcrumb = self.__generate_breadcrumb(url)
-
-    def set_snippet(self, html_string, query) -> None:
-        self.snippet = self.snippet_generator.generate_snippet(html_string, query)
-
-    def __get_domain(self, url: str) -> str:
-        return tldextract.extract(url).domain.title()
-
-    def __generate_breadcrumb(self, url: str) -> str:
-        url = urlparse(url)
+        self.domain = domain
+        self.breadcrumb = breadcrumb
+        self.snippet = ""
+
+    @classmethod
+    def from_row(cls, row, domain, breadcrumb) -> "SearchResult":
+        """
+        Create a `SearchResult` from a row returned by `SEARCH_PAGES_SQL`.
+        """
+        TITLE_WIDTH_CHARS = 60
+        return cls(
+            url=row.url,
+            title=shorten(row.title, width=TITLE_WIDTH_CHARS, placeholder="..."),
+            domain=domain,
+            breadcrumb=breadcrumb,
+        )
 
-        breadcrumb = url.netloc + url.path
-        breadcrumb = breadcrumb.replace("/", " > ")
-        breadcrumb = breadcrumb.removesuffix(
-            " > "
-        )  # Some paths may have a trailing `/`
 
-        return breadcrumb
+def generate_snippet_from_html(page_id, html_string, pattern) -> Markup:
+    """
+    Generate the snippet of a page that was crawled before the crawler stored its text, by extracting the text from its html first.
+    """
+    return snippet_generator.generate_snippet(
+        _extract_page_text(page_id, html_string), pattern
+    )
 
 
 @app.route("/")
@@ -49,51 +115,71 @@ def front_page() -> str:
 
 
 @app.route("/search")
-def search_results() -> str:
-    query = word_tokenize(request.args.get("q").lower())
+def search_results() -> str | Iterator[str]:
+    query = query_term_pattern.findall(request.args.get("q", "").lower())
     query = [term for term in query if term not in stop_words]
 
-    conn = db_conn()
-
-    sql = """
-        SELECT pages.url, pages.title, pages.html
-        FROM terms
-        -- Basically, each() will extract each value in an hstore into an array. Then,
-        -- CROSS JOIN LATERAL will then extract the array elements into separate rows,
-        -- with columns called `page_id` and `tf_idf_score`.
-        CROSS JOIN LATERAL each(tf_idf_scores) AS kv(page_id, tf_idf_score)
-        -- Then, connect the two tables by their page id columns
-        JOIN pages ON pages.id = page_id::integer
-        WHERE term = ANY(%s)
-        -- If two terms have TF-IDF scores for the same page, then add them up
-        GROUP BY pages.id, pages.url, pages.title, pages.html
-        -- Order with tf_idf scores from largest to smallest, giving a boost to pages with more terms in the query
-        ORDER BY SUM(tf_idf_score::real) * COUNT(term) DESC
-        LIMIT 10;
-    """
+    # Queries with nothing but stop words can't match any pages, so don't bother querying the database
+    if not query:
+        return render_template("no_results.html")
+
+    # Cap the number of terms to keep the database query and the snippet pattern small
+    MAX_QUERY_TERMS = 20
+    query = query[:MAX_QUERY_TERMS]
 
-    conn.execute(sql, (query,))
-    results = conn.fetchall()
+    # The results page is streamed, so only hold on to the connection while fetching the rows, instead of until the whole page is sent
+    with db_conn(pool) as cur:
+        # Prepare the query on each connection, so Postgres doesn't have to parse and plan it again on every search
+        cur.execute(SEARCH_PAGES_SQL, {"terms": query}, prepare=True)
+        rows = cur.fetchall()
 
-    if not results:
+    if not rows:
         return render_template("no_results.html")
 
-    # Add the page domain and breadcrumb to the results, so it can be shown to the user on the frontend
-    for i, result in enumerate(results):
-        url = result[0]
-        title = result[1]
-        html_string = result[2]
+    # The terms are sorted so that the same terms in a different order (e.g. `rust book` and `book rust`) share a cached pattern and snippets
+    terms = tuple(sorted(set(query)))
+    # The query is the same for every result, so only compile its pattern once
+    pattern = _compile_regex_for_query(terms)
 
-        TITLE_WIDTH_CHARS = 60
-        result = SearchResult(
-            url=url,
-            title=shorten(title, width=TITLE_WIDTH_CHARS, placeholder="..."),
-        )
-        result.set_snippet(html_string, query)
+    # Parse each url once, and derive both the page domain and breadcrumb from it, so they can be shown to the user on the frontend
+    parsed_urls = [urlparse(row.url) for row in rows]
+    domains = [get_domain(url.netloc) for url in parsed_urls]
+    breadcrumbs = [generate_breadcrumb(url.netloc, url.path) for url in parsed_urls]
 
-        results[i] = result
+    # Popular queries keep bringing up the same pages, so reuse the snippets that were already generated for them
+    cached_snippets = [snippet_cache.get((row.id, terms)) for row in rows]
 
-    return render_template("results.html", results=results)
+    # The crawler stores the text of each page, so only pages that don't have it need their html to be parsed
+    # Their snippets are generated in the pool as well, while the results before them are being rendered
+    snippets_from_html = {
+        i: html_parser_pool.submit(
+            generate_snippet_from_html, row.id, row.html, pattern
+        )
+        for i, row in enumerate(rows)
+        if row.body_text is None and cached_snippets[i] is None
+    }
+
+    def generate_results() -> Iterator[SearchResult]:
+        for i, (row, domain, breadcrumb, snippet) in enumerate(
+            zip(rows, domains, breadcrumbs, cached_snippets)
+        ):
+            result = SearchResult.from_row(row, domain, breadcrumb)
+
+            if snippet is None:
+                if row.body_text is not None:
+                    text = row.body_text
+                    if row.window_start > 1:
+                        text = _trim_text_window(text, pattern)
+                    snippet = snippet_generator.generate_snippet(text, pattern)
+                else:
+                    snippet = snippets_from_html[i].result()
+                snippet_cache.put((row.id, terms), snippet)
+
+            result.snippet = snippet
+            yield result
+
+    # Render each result as soon as it is created, instead of building every result and the whole page in memory first
+    return stream_template("results.html", results=generate_results())
 
 
 if __name__ == "__main__":
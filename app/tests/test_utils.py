@@ -1,8 +1,13 @@
 import pytest
 from utils import (
+    _compile_regex_for_query,
+    _extract_page_text,
     _extract_paragraph_text,
+    _LRUCache,
     _split_text_by_punctuation,
+    _trim_text_window,
     _SnippetGenerator,
+    generate_breadcrumb,
 )
 from pathlib import Path
 
@@ -16,15 +21,78 @@ def test_generate_snippet(snippet_generator: _SnippetGenerator):
     fixture_path = Path(__file__).parent / "fixtures" / "wikipedia_article.html"
     with open(fixture_path, "r") as f:
         html_string = f.read()
-    query = ["hello"]
-    expected_snippet = r"""<span class="prompt-bold">&#34;Hello&#34; is a song recorded by British singer-songwriter Adele,</span> released on 23 October 2015 by XL Recordings as the lead single from her third studio album,..."""
+    text = _extract_paragraph_text(html_string)
+    pattern = _compile_regex_for_query(("hello",))
+    expected_snippet = r"""<span class="prompt-bold">&#34;Hello&#34; is a song recorded by British singer-songwriter Adele,</span> released on 23 October 2015 by XL Recordings as the lead single from her third studio album, 25 (2015). Written by Adele and the..."""
 
-    assert snippet_generator.generate_snippet(html_string, query) == expected_snippet
+    assert snippet_generator.generate_snippet(text, pattern) == expected_snippet
+
+
+def test_generate_snippet_does_not_repeat_phrases(
+    snippet_generator: _SnippetGenerator,
+):
+    text = "Hello, my friend. The weather is nice today, and the sun is out. We should go for a walk."
+    pattern = _compile_regex_for_query(("hello",))
+    expected_snippet = r"""<span class="prompt-bold">Hello, my friend. The weather is nice today, and the sun is out.</span> We should go for a walk."""
+
+    assert snippet_generator.generate_snippet(text, pattern) == expected_snippet
+
+
+def test_generate_snippet_truncates_long_phrases(
+    snippet_generator: _SnippetGenerator,
+):
+    text = "hello " * 50
+    pattern = _compile_regex_for_query(("hello",))
+    expected_snippet = (
+        r"""<span class="prompt-bold">""" + "hello " * 32 + r"""hello</span>..."""
+    )
+
+    assert snippet_generator.generate_snippet(text, pattern) == expected_snippet
+
+
+def test_generate_snippet_trims_long_previous_phrases(
+    snippet_generator: _SnippetGenerator,
+):
+    text = " ".join(["word"] * 60) + ", hello."
+    pattern = _compile_regex_for_query(("hello",))
+    expected_snippet = (
+        "word " * 37 + r"""word, <span class="prompt-bold">hello.</span>"""
+    )
+
+    assert snippet_generator.generate_snippet(text, pattern) == expected_snippet
+
+
+def test_generate_snippet_from_text_window(snippet_generator: _SnippetGenerator):
+    text = "Intro. " + "abcdefg " * 45 + "hello there friend. The end."
+    pattern = _compile_regex_for_query(("hello",))
+
+    # Cut the text the same way SEARCH_PAGES_SQL does, which starts the window in the middle of a word
+    window_start = max(text.lower().find("hello") + 1 - 300, 1)
+    window = text[window_start - 1 : window_start - 1 + 1000]
+    assert not window.startswith(("abcdefg", " "))
+
+    # The snippet starts at the first whole word of the window, not in the middle of a word
+    expected_snippet = (
+        r"""<span class="prompt-bold">""" + "abcdefg " * 23 + r"""abcdefg</span>..."""
+    )
+
+    assert (
+        snippet_generator.generate_snippet(_trim_text_window(window, pattern), pattern)
+        == expected_snippet
+    )
+
+
+def test_trim_text_window():
+    pattern = _compile_regex_for_query(("hello",))
+
+    assert _trim_text_window("lo world. hello there.", pattern) == " hello there."
+    # The match is in the partial phrase, so only the partial word is dropped
+    assert _trim_text_window("lo world hello there.", pattern) == "world hello there."
 
 
 def test_split_text_by_punctuation():
     text = "hello. hello hello! hello?"
-    assert _split_text_by_punctuation(text) == [
+    assert list(_split_text_by_punctuation(text)) == [
         "hello.",
         " hello hello!",
         " hello?",
@@ -38,3 +106,48 @@ def test_extract_text():
     assert (
         _extract_paragraph_text(html_string) == "hippopotamus hippopotamus hippopotamus"
     )
+
+
+def test_extract_page_text_is_cached_by_page_id():
+    html_string = r"""<body>
+                        <p>hippopotamus hippopotamus hippopotamus</p>
+                      </body>"""
+    assert _extract_page_text(0, html_string) == "hippopotamus hippopotamus hippopotamus"
+
+    # The page has already been parsed, so its HTML shouldn't be parsed again
+    assert _extract_page_text(0, "") == "hippopotamus hippopotamus hippopotamus"
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = _LRUCache(max_size=2)
+    cache.put(0, "hippopotamus")
+    cache.put(1, "hippopotamus")
+
+    # Using the first value makes the second one the least recently used
+    assert cache.get(0) == "hippopotamus"
+    cache.put(2, "hippopotamus")
+
+    assert cache.get(1) is None
+    assert cache.get(0) == "hippopotamus"
+    assert cache.get(2) == "hippopotamus"
+
+
+def test_extract_text_with_line_breaks():
+    html_string = r"""<body>
+                        <p>hippopotamus<br>hippopotamus<br/>hippopotamus</p>
+                      </body>"""
+    assert (
+        _extract_paragraph_text(html_string) == "hippopotamus hippopotamus hippopotamus"
+    )
+
+
+def test_generate_breadcrumb():
+    assert (
+        generate_breadcrumb("en.wikipedia.org", "/wiki/Hello/")
+        == "en.wikipedia.org > wiki > Hello"
+    )
+
+
+def test_compile_regex_for_query():
+    pattern = _compile_regex_for_query(("art", "article", "art"))
+    assert pattern.search("An article!").group() == "article!"
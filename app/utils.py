@@ -1,99 +1,296 @@
 import os
 import re
-from textwrap import shorten
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Lock
 
-import psycopg2
-from lxml import html
-from markupsafe import escape
-from psycopg2.extensions import cursor
+import re2
+import tldextract
+from markupsafe import Markup
+from psycopg import Cursor
+from psycopg.rows import namedtuple_row
+from psycopg_pool import ConnectionPool
+from selectolax.lexbor import LexborHTMLParser
 
 
 def _extract_paragraph_text(html_string: str) -> str:
     """
     Extract text from <p> tags in a string of HTML.
     """
-    tree = html.fromstring(html_string)
-    paragraphs = tree.xpath("//p")
-    # TODO: Replace <br> tags with spaces
-    return " ".join(p.text_content() for p in paragraphs)
+    tree = LexborHTMLParser(html_string)
 
+    # Line breaks separate words just like spaces do
+    for line_break in tree.css("p br"):
+        line_break.replace_with(" ")
 
-def _split_text_by_punctuation(text: str) -> list[str]:
-    return re.findall(r"[^?.,!]+[?.,!]?|[^?.,!]+$", text)
+    paragraphs = tree.css("p")
+    return " ".join(p.text() for p in paragraphs)
 
 
-def _compile_regex_for_query(query: list[str]) -> re.Pattern[str]:
-    return re.compile(
-        r"(" + "|".join(map(re.escape, query)) + r")[^\w\s]*", re.IGNORECASE
+class _LRUCache:
+    """
+    A thread-safe cache that evicts the least recently used value once it holds more than `max_size` values.
+
+    Unlike `functools.lru_cache`, the key is chosen by the caller, so that large arguments (e.g. the HTML of a page) don't have to be hashed or kept alive by the cache.
+    """
+
+    __slots__ = ("max_size", "_values", "_lock")
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        Returns the value cached under `key`, or `None` if there is none.
+        """
+        with self._lock:
+            if key not in self._values:
+                return None
+            self._values.move_to_end(key)
+            return self._values[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            # Evict the least recently used value
+            if len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+
+_page_text_cache = _LRUCache(max_size=2048)
+
+
+def _extract_page_text(page_id: int, html_string: str) -> str:
+    """
+    Extract text from <p> tags in the HTML of a page (see `_extract_paragraph_text()`).
+
+    The text is cached by the id of the page, so the HTML of a page is only parsed the first time it shows up in the search results. Only the extracted text is cached, not the HTML.
+    """
+    text = _page_text_cache.get(page_id)
+    if text is None:
+        text = _extract_paragraph_text(html_string)
+        _page_text_cache.put(page_id, text)
+
+    return text
+
+
+_PHRASE_PUNCTUATION = "?.,!"
+# A phrase is a run of text up to and including the next punctuation mark. The last phrase in a text may not end with one.
+_PHRASE_PATTERN = re.compile(r"[^?.,!]+[?.,!]?")
+
+
+def _split_text_by_punctuation(text: str, start: int = 0) -> Iterator[str]:
+    """
+    Lazily split `text` into phrases that end with punctuation, so that the caller can stop splitting once it finds the phrase it's looking for.
+
+    Splitting begins at index `start` of `text`, which should be the start of a phrase (see `_find_phrase_start()`).
+    """
+    return (match.group() for match in _PHRASE_PATTERN.finditer(text, start))
+
+
+def _find_phrase_start(text: str, index: int) -> int:
+    """
+    Returns the index in `text` where the phrase containing the character at `index` starts (see `_split_text_by_punctuation()`).
+    """
+    return (
+        max(text.rfind(punctuation, 0, index) for punctuation in _PHRASE_PUNCTUATION)
+        + 1
     )
 
 
+# Popular queries get searched over and over, so reuse their compiled patterns
+@lru_cache(maxsize=1024)
+def _compile_regex_for_query(query: tuple[str, ...]) -> re2._Regexp:
+    # Use RE2 since it matches every term of the query in a single linear-time pass, instead of backtracking through each term of the alternation
+    # Drop repeated terms, and put longer terms first so that a term that is a prefix of another (e.g. `art` and `article`) doesn't cut the match short
+    terms = sorted(set(query), key=lambda term: (-len(term), term))
+    return re2.compile(r"(?i)(" + "|".join(map(re2.escape, terms)) + r")[^\w\s]*")
+
+
+def _trim_text_window(window: str, pattern: re2._Regexp) -> str:
+    """
+    Drop the partial phrase at the start of `window`, a piece of the text of a page that doesn't start at the beginning of the text (see `SEARCH_PAGES_SQL` in `main.py`), so that snippets never start in the middle of a phrase.
+
+    If the first match of `pattern` is in that partial phrase, only the partial word at the start of `window` is dropped instead, so the match is kept.
+    """
+    match = pattern.search(window)
+    match_start = match.start() if match is not None else len(window)
+
+    phrase_end = min(
+        (
+            index
+            for index in map(window.find, _PHRASE_PUNCTUATION)
+            if index != -1 and index < match_start
+        ),
+        default=-1,
+    )
+    if phrase_end != -1:
+        return window[phrase_end + 1 :]
+
+    word_end = window.find(" ", 0, match_start)
+    return window[word_end + 1 :]
+
+
+_SNIPPET_WIDTH_CHARS = 200
+# The bold phrase is elongated up to this many characters, so a short phrase doesn't get lost in the rest of the snippet
+_BOLD_PHRASE_WIDTH_CHARS = 60
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_SNIPPET = Markup('{before}<span class="prompt-bold">{phrase}</span>{after}{ellipsis}')
+
+
+def _find_snippet_end(snippet: str, width: int) -> int:
+    """
+    Returns the index to cut `snippet` at so that it fits within `width` characters once a '...' is added to the end, without cutting a word in half. The length of `snippet` is returned if it already fits.
+    """
+    if len(snippet) <= width:
+        return len(snippet)
+
+    end = snippet.rfind(" ", 0, width - 2)
+    # Cut the word in half if it's the only one
+    if end <= 0:
+        end = width - 3
+
+    return len(snippet[:end].rstrip())
+
+
 class _SnippetGenerator:
-    def generate_snippet(self, html_string: str, query_terms: list[str]) -> str:
+    # The snippet generator holds no state, so don't give its instances a `__dict__`
+    __slots__ = ()
+
+    @staticmethod
+    def generate_snippet(text: str, pattern: re2._Regexp) -> Markup:
         """
-        Returns an HTML snippet of visible text in an HTML string based on a list of query terms.
+        Returns an HTML snippet of the visible text of a page based on a pattern compiled from the query terms (see `_compile_regex_for_query()`).
 
-        The function extracts any text inside of <p> tags. This text is then split by punctuation into multiple phrases, and finds the first phrase that contains at least one term from the query. This phrase is the root phrase of the snippet, and will be wrapped in a <span> tag to add styling. The final snippet will be truncated with a '...' if it exceeds a certain character count.`
+        `text` is the text inside of the <p> tags of the page (see `_extract_page_text()`). The first match of `pattern` is found in `text`, and only the text around this match is split by punctuation into multiple phrases. The phrase that contains the match is the root phrase of the snippet, and will be wrapped in a <span> tag to add styling. The final snippet will be truncated with a '...' if it exceeds a certain character count.`
 
-        An empty string will be returned if no phrases with terms from the query are found.
+        The snippet is returned as `Markup`, so Jinja renders it without escaping it again. An empty string will be returned if no phrases with terms from the query are found.
         """
-        text = _extract_paragraph_text(html_string)
-        pattern = _compile_regex_for_query(query_terms)
-        phrases = _split_text_by_punctuation(text)
+        # Search the whole text at once, rather than splitting it into phrases and searching each phrase until one matches
+        match = pattern.search(text)
+        if match is None:
+            return Markup("")
 
-        snippet = ""
-        for i, phrase in enumerate(phrases):
-            # If a term in the query is found in the phrase
-            if pattern.search(phrase):
-                phrase = self.__elongate_phrase(i, phrases, phrase)
+        root_phrase_start = _find_phrase_start(text, match.start())
 
-                # Convert any html tags to plain-text
-                phrase = escape(phrase.lstrip())
+        # Skip back over the punctuation between the root phrase and the phrase before it, which doesn't belong to either of them
+        previous_phrase_end = root_phrase_start
+        while (
+            previous_phrase_end > 0
+            and text[previous_phrase_end - 1] in _PHRASE_PUNCTUATION
+        ):
+            previous_phrase_end -= 1
 
-                # Bolden the phrase with the term from the query
-                snippet += rf'<span class="prompt-bold">{phrase}</span>'
+        if previous_phrase_end > 0:
+            phrases = _split_text_by_punctuation(
+                text, _find_phrase_start(text, previous_phrase_end - 1)
+            )
+            previous_phrase = next(phrases)
+        else:
+            phrases = _split_text_by_punctuation(text, root_phrase_start)
+            previous_phrase = None
 
-                snippet = self.__elongate_snippet(i, phrases, snippet)
+        phrase = next(phrases)
 
-                SNIPPET_WIDTH_CHARS = 200
-                snippet = shorten(snippet, width=SNIPPET_WIDTH_CHARS, placeholder="...")
+        # Both elongations take phrases from the same iterator, so the snippet picks up right after the last phrase added to the root phrase
+        phrase = _SnippetGenerator.__elongate_phrase(phrase, phrases)
+        before, after = _SnippetGenerator.__elongate_snippet(
+            phrase, phrases, previous_phrase
+        )
 
-                return snippet
+        # Collapse the line breaks and indentation left over from the html into single spaces
+        before = _WHITESPACE_PATTERN.sub(" ", before).lstrip()
+        phrase = _WHITESPACE_PATTERN.sub(" ", phrase).strip()
+        after = _WHITESPACE_PATTERN.sub(" ", after).rstrip()
 
-        return snippet
+        # The phrase before the root phrase is only there to fill up the snippet, so trim it from the left instead of letting it push the root phrase out of the snippet
+        overflow = len(before) + len(phrase) + len(after) - _SNIPPET_WIDTH_CHARS
+        if overflow > 0:
+            word_start = before.find(" ", overflow)
+            before = before[word_start + 1 :] if word_start != -1 else ""
 
+        # Truncate the plain text of the snippet before marking it up, so the <span> tag doesn't count towards the width and can't get cut off
+        snippet = before + phrase + after
+        end = _find_snippet_end(snippet, _SNIPPET_WIDTH_CHARS)
+        phrase_start = len(before)
+        phrase_end = phrase_start + len(phrase)
+
+        # Bolden the phrase with the term from the query. Formatting the text into Markup converts any html tags in it to plain-text.
+        return _SNIPPET.format(
+            before=snippet[: min(end, phrase_start)],
+            phrase=snippet[phrase_start : min(end, phrase_end)],
+            after=snippet[phrase_end:end],
+            ellipsis="..." if end < len(snippet) else "",
+        )
+
+    @staticmethod
     def __elongate_snippet(
-        self, current_index: int, phrases: list[str], snippet: str
-    ) -> str:
+        phrase: str, phrases: Iterator[str], previous_phrase: str | None
+    ) -> tuple[str, str]:
         """
-        Elongate `snippet` by adding other phrases from `phrases` until `snippet` reaches a certain character count.
+        Elongate the snippet around the root phrase `phrase` by adding the next phrases from `phrases` until the snippet reaches a certain character count. If there are not enough phrases left, `previous_phrase` (the phrase before the root phrase) is added to the start of the snippet instead.
+
+        Returns the text that goes before and after `phrase` in the snippet.
         """
-        counter = 1
-        while len(snippet) < 200 or counter < 3:
-            # Add second phrase to snippet
-            if current_index + counter < len(phrases):
-                snippet += " " + phrases[current_index + counter]
-                counter += 1
-            # Add the phrase before the current one if there is no phrase afterwards
-            else:
-                snippet = phrases[current_index - 1] + " " + snippet
-                return snippet
-        return snippet
-
-    def __elongate_phrase(
-        self, current_index: int, phrases: list[str], current_phrase: str
-    ) -> tuple[str]:
+        # Collect the phrases in a list instead of concatenating them, since strings are immutable and would be copied each time
+        parts = []
+        length = len(phrase)
+
+        # The phrases are next to each other in the text, and keep the whitespace in between them, so they are joined without adding any spaces
+        for counter, next_phrase in enumerate(phrases, start=1):
+            parts.append(next_phrase)
+            length += len(next_phrase)
+            if length >= _SNIPPET_WIDTH_CHARS and counter >= 2:
+                return "", "".join(parts)
+
+        # Add the phrase before the root phrase if there are no phrases afterwards
+        if previous_phrase is not None:
+            return previous_phrase + " ", "".join(parts)
+        return "", "".join(parts)
+
+    @staticmethod
+    def __elongate_phrase(current_phrase: str, phrases: Iterator[str]) -> str:
         """
-        Elongate `current_phrase` by adding other phrases from `phrases` until `current_phrase` reaches a certain character count.
+        Elongate `current_phrase` by adding the next phrases from `phrases` until `current_phrase` reaches a certain character count.
 
         Note that `current_phrase` is the section of the snippet that is wrapped with a <span> tag to add styling (see `_SnippetGenerator.generate_snippet()`).
         """
-        counter = 1
-        while len(current_phrase) < 60 and current_index + counter < len(phrases):
-            current_phrase += " " + phrases[current_index + counter]
-            counter += 1
+        parts = [current_phrase]
+        length = len(current_phrase)
+
+        while length < _BOLD_PHRASE_WIDTH_CHARS:
+            next_phrase = next(phrases, None)
+            if next_phrase is None:
+                break
+            parts.append(next_phrase)
+            length += len(next_phrase)
+
+        return "".join(parts)
+
+
+# Private domains (e.g. blogspot.com) are not treated as public suffixes, so they show up as the domain of a result
+domain_extractor = tldextract.TLDExtract(include_psl_private_domains=False)
+
+
+# Search results often come from the same handful of sites, so cache the parsed domains and breadcrumbs
+@lru_cache(maxsize=4096)
+def get_domain(netloc: str) -> str:
+    return domain_extractor(netloc).domain.title()
+
 
-        return current_phrase
+@lru_cache(maxsize=4096)
+def generate_breadcrumb(netloc: str, path: str) -> str:
+    breadcrumb = netloc + path
+    breadcrumb = breadcrumb.replace("/", " > ")
+    breadcrumb = breadcrumb.removesuffix(" > ")  # Some paths may have a trailing `/`
+
+    return breadcrumb
 
 
 def retrieve_env_var(var: str) -> str:
@@ -103,16 +300,44 @@ def retrieve_env_var(var: str) -> str:
         raise RuntimeError(f"Missing required environment variable: {var}")
 
 
-def db_conn() -> cursor:
+def init_pool() -> ConnectionPool:
+    """
+    Create a pool of connections to the database from the `DB_NAME`, `DB_USER`, `DB_PASSWORD`, and `DB_ENDPOINT` environment variables.
+
+    Connections are kept open between requests, so a request does not have to reconnect to the database every time it runs a query. Raises `PoolTimeout` if the pool can't connect to the database, so a misconfigured app fails at startup instead of on every search.
+    """
     database = retrieve_env_var("DB_NAME")
     user = retrieve_env_var("DB_USER")
     password = retrieve_env_var("DB_PASSWORD")
     host = retrieve_env_var("DB_ENDPOINT")
 
-    conn = psycopg2.connect(
-        database=database, user=user, password=password, host=host, port="5432"
+    pool = ConnectionPool(
+        min_size=2,
+        max_size=20,
+        kwargs={
+            "dbname": database,
+            "user": user,
+            "password": password,
+            "host": host,
+            "port": "5432",
+            # Return rows as named tuples, so columns can be accessed by name
+            "row_factory": namedtuple_row,
+        },
+        open=True,
     )
+    # The pool connects in the background, so wait for its first connections to make sure the database can be reached
+    pool.wait(timeout=10.0)
 
-    cursor = conn.cursor()
+    return pool
 
-    return cursor
+
+@contextmanager
+def db_conn(pool: ConnectionPool) -> Iterator[Cursor]:
+    """
+    Check out a connection from `pool` and yield a cursor to it. The cursor returns rows as named tuples, so columns can be accessed by name.
+
+    The connection is handed back to the pool as soon as the `with` block exits, even if an exception is raised inside of it.
+    """
+    # The pool ends the transaction when the connection is returned, so it goes back to the pool idle
+    with pool.connection() as conn, conn.cursor() as cur:
+        yield cur
@@ -0,0 +1,3 @@
+-- Store the text of each page's <p> tags, so the app doesn't have to parse the html to generate snippets
+ALTER TABLE pages
+ADD COLUMN IF NOT EXISTS body_text text;
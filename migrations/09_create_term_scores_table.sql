@@ -0,0 +1,33 @@
+-- Store each TF-IDF score in its own row, so searching for a term is an index
+-- scan instead of expanding the term's whole hstore
+CREATE TABLE IF NOT EXISTS term_scores (
+    term text NOT NULL,
+    page_id integer NOT NULL,
+    score real NOT NULL,
+    -- Include the score in the index, so that searches never have to read the table itself
+    PRIMARY KEY (term, page_id) INCLUDE (score)
+);
+
+INSERT INTO term_scores (term, page_id, score)
+SELECT term, page_id::integer, tf_idf_score::real
+FROM terms
+CROSS JOIN LATERAL each(tf_idf_scores) AS kv(page_id, tf_idf_score)
+ON CONFLICT DO NOTHING;
+
+-- The indexer rewrites all of a term's scores whenever its IDF changes, so
+-- rewrite the term's rows in term_scores along with it
+CREATE OR REPLACE FUNCTION sync_term_scores() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM term_scores WHERE term = NEW.term;
+
+    INSERT INTO term_scores (term, page_id, score)
+    SELECT NEW.term, page_id::integer, tf_idf_score::real
+    FROM each(NEW.tf_idf_scores) AS kv(page_id, tf_idf_score);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER sync_term_scores
+AFTER INSERT OR UPDATE OF tf_idf_scores ON terms
+FOR EACH ROW EXECUTE FUNCTION sync_term_scores();
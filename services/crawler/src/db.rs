@@ -100,15 +100,16 @@ impl DbManager for RealDbManager {
     /// Update the database entry for this [`CrawledPage`].
     ///
     /// This will update the row in the `pages` table that matches the
-    /// [`CrawledPage`]'s URL, setting its `html`, `title`, and marking
-    /// `is_crawled` as `TRUE`.
+    /// [`CrawledPage`]'s URL, setting its `html`, `title`, `body_text`, and
+    /// marking `is_crawled` as `TRUE`.
     async fn add_crawled_page_to_db(&self, page: &CrawledPage) {
         let query = r#"
             UPDATE pages
             SET html = $1,
                 title = $2,
+                body_text = $3,
                 is_crawled = TRUE
-            WHERE url = $3"#;
+            WHERE url = $4"#;
 
         // Usually this will throw an error if the url is too large to store in
         // the db. However, a large url usually redirects to somewhere else, so we
@@ -116,6 +117,7 @@ impl DbManager for RealDbManager {
         let _ = sqlx::query(query)
             .bind(page.html.html())
             .bind(page.title.clone())
+            .bind(page.body_text())
             .bind(page.url.to_string())
             .execute(&self.pool)
             .await;
@@ -1,10 +1,15 @@
+use once_cell::sync::Lazy;
 use reqwest::Url;
-use scraper::Html;
+use scraper::{Html, Node, Selector};
 use std::collections::{HashSet, VecDeque};
 use std::sync::Arc;
 
 use crate::db::DbManager;
 
+static PARAGRAPH_SELECTOR: Lazy<Selector> = Lazy::new(|| {
+    Selector::parse("p").expect("Parsing 'p' selector should not throw an error.")
+});
+
 #[derive(Debug, Hash, Eq, PartialEq, Clone)]
 pub struct Page {
     pub url: Url,
@@ -55,6 +60,28 @@ impl CrawledPage {
             html,
         }
     }
+
+    /// Extract the text inside of the `<p>` tags of the page, with each
+    /// paragraph separated by a space. Any `<br>` tags are replaced with a
+    /// space as well.
+    ///
+    /// This gets stored alongside the page's HTML, so that the app can
+    /// generate snippets for search results without parsing the HTML itself.
+    pub fn body_text(&self) -> String {
+        self.html
+            .select(&PARAGRAPH_SELECTOR)
+            .map(|p| {
+                p.descendants()
+                    .filter_map(|node| match node.value() {
+                        Node::Text(text) => Some(&**text),
+                        Node::Element(element) if element.name() == "br" => Some(" "),
+                        _ => None,
+                    })
+                    .collect::<String>()
+            })
+            .collect::<Vec<_>>()
+            .join(" ")
+    }
 }
 
 impl PartialEq<Page> for CrawledPage {
@@ -140,3 +167,53 @@ impl PartialEq<VecDeque<Page>> for PageQueue {
         self.queue == *other
     }
 }
+
+#[cfg(test)]
+mod test {
+    use super::*;
+
+    mod body_text {
+        use super::*;
+
+        fn crawled_page_from_html(html: &str) -> CrawledPage {
+            let url = Url::parse("https://example.com").expect("URL should be valid.");
+            Page::new(url).into_crawled(None, Html::parse_document(html))
+        }
+
+        #[test]
+        fn test_body_text() {
+            let page = crawled_page_from_html(
+                r#"
+                <body>
+                    <h1>heading</h1>
+                    <p>hippopotamus <b>hippopotamus</b></p>
+                    <p>hippopotamus</p>
+                </body>"#,
+            );
+
+            assert_eq!(
+                page.body_text(),
+                "hippopotamus hippopotamus hippopotamus"
+            );
+        }
+
+        #[test]
+        fn test_body_text_with_line_breaks() {
+            let page = crawled_page_from_html(
+                "<body><p>hippopotamus<br>hippopotamus<br/>hippopotamus</p></body>",
+            );
+
+            assert_eq!(
+                page.body_text(),
+                "hippopotamus hippopotamus hippopotamus"
+            );
+        }
+
+        #[test]
+        fn test_body_text_without_paragraphs() {
+            let page = crawled_page_from_html("<body><h1>heading</h1></body>");
+
+            assert_eq!(page.body_text(), "");
+        }
+    }
+}